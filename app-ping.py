@@ -1,69 +1,126 @@
 import json
+import orjson
+import simdjson
 import gradio as gr
 import paho.mqtt.client as mqtt
+import secrets
+import socket
 import time
-from queue import Queue
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
 
 # 简单的全局配置和状态
 MQTT_HOST = "broker.hivemq.com"
 MQTT_PORT = 1883
-response_queue = Queue()
+# 模块级 Parser 复用 simdjson 的 tape 缓冲区（paho 回调只在一个网络线程上跑，无需加锁）
+_PARSER = simdjson.Parser()
+
+# 按消息长度分流：小消息上 FFI/解析器启动开销占主导，stdlib 反而更快；
+# 大消息才吃得到 SIMD 的解析带宽
+def fast_loads(payload):
+    if len(payload) > 256:
+        return _PARSER.parse(payload).as_dict()
+    return json.loads(payload)
+# 单生产者（paho 网络线程）单消费者（UI 刷新），GIL 下 deque 的 append/clear
+# 本身线程安全，不需要 Queue 的互斥锁；maxlen 同时提供自动背压
+response_queue = deque(maxlen=1000)
 mqtt_client = None
 session_id = None
+# 热路径上不再逐条打日志，用计数器观测吞吐
+msg_count = 0
 
 # 基础的 MQTT 回调函数
-def on_connect(client, userdata, flags, rc):
-    print(f"Connected with result code {rc}")
+def on_connect(client, userdata, flags, reason_code, properties):
+    logger.info("Connected with result code %s", reason_code)
     if session_id:
         client.subscribe(f"pong/{session_id}/response")
 
 def on_message(client, userdata, msg):
+    global msg_count
     try:
-        response = json.loads(msg.payload.decode())
-        response_queue.put(response)
-        print(f"Received: {response}")
+        # 解析器直接接受 bytes，省掉 decode
+        response = fast_loads(msg.payload)
+        response_queue.append(response)
+        msg_count += 1
+        # 懒格式化：级别被过滤时不做 dict→str 转换
+        logger.debug("Received: %s", response)
     except Exception as e:
-        print(f"Error processing message: {e}")
+        logger.error("Error processing message: %s", e)
+
+# 连接后的 socket 调优：小控制消息禁用 Nagle，避免最多 40ms 的发送延迟
+def tune_socket(client):
+    sock = client.socket()
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if hasattr(socket, "TCP_QUICKACK"):  # 仅 Linux
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+    # 增大发送缓冲区，突发 publish 可以整批塞进内核
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
 
 # 简单的会话初始化
 def initialize_session():
     global mqtt_client, session_id
-    session_id = f"ping_{int(time.time())}"
-    mqtt_client = mqtt.Client()
+    # 已连接则复用同一个客户端（不重付 TCP+MQTT 握手、不泄漏旧网络线程），
+    # 但仍然换发新的 session_id 并改订对应的响应主题
+    if mqtt_client is not None and mqtt_client.is_connected():
+        old_session = session_id
+        session_id = f"ping_{secrets.token_hex(4)}"
+        if old_session:
+            mqtt_client.unsubscribe(f"pong/{old_session}/response")
+        mqtt_client.subscribe(f"pong/{session_id}/response")
+        return f"Connected with session: {session_id}"
+    # 随机 ID：秒级时间戳在同一秒内重复初始化会撞出共享的响应主题
+    session_id = f"ping_{secrets.token_hex(4)}"
+    # v2 回调 API：绕开 paho 对旧版回调签名的逐次适配层
+    mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
     mqtt_client.on_connect = on_connect
     mqtt_client.on_message = on_message
+    # 放宽在途/排队消息上限，让连续 publish 背靠背发送而不是被逐条限流
+    mqtt_client.max_inflight_messages_set(100)
+    mqtt_client.max_queued_messages_set(0)
     mqtt_client.connect(MQTT_HOST, MQTT_PORT, 60)
+    tune_socket(mqtt_client)
     mqtt_client.loop_start()
     return f"Connected with session: {session_id}"
 
-# 发送命令的基础函数
-def send_command(command_type, data=None):
-    if not mqtt_client:
-        return "Please initialize session first"
-    
-    payload = {
-        "type": command_type,
-        "data": data or {},
-        "session_id": session_id,
-        "timestamp": time.time()
-    }
-    
-    mqtt_client.publish("ping/command", json.dumps(payload))
-    return f"Sent {command_type}"
+# 固定形状的命令预编码成字节模板，publish 时只填变化的数字字段，
+# 跳过每次发送的 dict 构建和完整 JSON 编码
+_RGB_TEMPLATE = (b'{"type":"RGB Command","data":{"r":%d,"g":%d,"b":%d},'
+                 b'"session_id":"%s","timestamp":%f}')
+_WEIGHT_TEMPLATE = (b'{"type":"Weight Data","data":{"set_rpm":%d,"request_weight":true},'
+                    b'"session_id":"%s","timestamp":%f}')
 
 # 简单的命令函数
 def send_rgb(r, g, b):
-    return send_command("RGB Command", {"r": r, "g": g, "b": b})
+    if not mqtt_client:
+        return "Please initialize session first"
+    payload = _RGB_TEMPLATE % (int(r), int(g), int(b), session_id.encode(), time.time())
+    mqtt_client.publish("ping/command", payload)
+    return "Sent RGB Command"
 
 def send_weight_request(rpm):
-    return send_command("Weight Data", {"set_rpm": rpm, "request_weight": True})
+    if not mqtt_client:
+        return "Please initialize session first"
+    payload = _WEIGHT_TEMPLATE % (int(rpm), session_id.encode(), time.time())
+    mqtt_client.publish("ping/command", payload)
+    return "Sent Weight Data"
 
-def check_responses():
-    responses = []
-    while not response_queue.empty():
-        response = response_queue.get_nowait()
-        responses.append(json.dumps(response, indent=2))
-    return "\n".join(responses) if responses else "No new responses"
+def stream_responses():
+    """通过单条长连接持续推送响应，取代每次点击一次 HTTP 往返的轮询"""
+    log = deque(maxlen=50)
+    while True:
+        # 逐条 popleft 排空：快照+clear 的组合不是原子的，两步之间
+        # 网络线程塞进来的消息会被 clear 悄悄丢掉
+        items = []
+        while response_queue:
+            items.append(response_queue.popleft())
+        for r in items:
+            log.append(orjson.dumps(r, option=orjson.OPT_INDENT_2).decode())
+        # 把消息计数随流输出，作为吞吐观测口
+        header = f"Received {msg_count} messages"
+        yield header + "\n" + "\n".join(log) if log else header
+        time.sleep(0.1)
 
 # Gradio 界面
 with gr.Blocks(title="MQTT Ping", theme=gr.themes.Soft(
@@ -99,8 +156,6 @@ with gr.Blocks(title="MQTT Ping", theme=gr.themes.Soft(
         # 右侧状态显示
         with gr.Column(scale=1, variant="panel"):
             gr.Markdown("### System Status")
-            with gr.Row():
-                check_btn = gr.Button("Refresh Status", variant="secondary")
             responses = gr.Textbox(
                 label="System Response",
                 lines=10,
@@ -112,7 +167,8 @@ with gr.Blocks(title="MQTT Ping", theme=gr.themes.Soft(
     connect_btn.click(initialize_session, outputs=status)
     send_rgb_btn.click(send_rgb, [r, g, b], rgb_status)
     send_weight_btn.click(send_weight_request, rpm, weight_status)
-    check_btn.click(check_responses, outputs=responses)
+    # 页面加载后由生成器持续推送响应，不再需要手动刷新按钮
+    demo.load(stream_responses, None, responses)
 
 if __name__ == "__main__":
     demo.launch()
\ No newline at end of file
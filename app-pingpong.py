@@ -1,19 +1,40 @@
 import json
+import orjson
+import simdjson
 import gradio as gr
 import paho.mqtt.client as mqtt
+import operator
+import secrets
+import socket
 import time
 import random
+import logging
+from collections import deque
 from queue import Queue
 
+logger = logging.getLogger(__name__)
+
 # 全局配置
 MQTT_HOST = "broker.hivemq.com"
 MQTT_PORT = 1883
+# 模块级 Parser 复用 simdjson 的 tape 缓冲区（paho 回调只在一个网络线程上跑，无需加锁）
+_PARSER = simdjson.Parser()
+
+# 按消息长度分流：小消息上 FFI/解析器启动开销占主导，stdlib 反而更快；
+# 大消息才吃得到 SIMD 的解析带宽
+def fast_loads(payload):
+    if len(payload) > 256:
+        return _PARSER.parse(payload).as_dict()
+    return json.loads(payload)
 
 # 全局状态
-response_queue = Queue()
+# 单生产者（paho 网络线程）单消费者（UI 刷新），GIL 下 deque 的 append/clear
+# 本身线程安全，不需要 Queue 的互斥锁；maxlen 同时提供自动背压
+response_queue = deque(maxlen=1000)
 command_queue = Queue()
-mqtt_ping_client = None
-mqtt_pong_client = None
+# Ping 和 Pong 共用一个客户端：单进程里开两条到 broker 的 TCP 连接
+# 只是白白多一条网络线程和 keepalive 流量
+mqtt_client = None
 session_id = None
 device_state = {
     "rgb": {"r": 0, "g": 0, "b": 0},
@@ -22,101 +43,134 @@ device_state = {
 }
 
 # MQTT 回调函数
-def on_ping_connect(client, userdata, flags, rc):
-    print(f"Ping connected with result code {rc}")
+def on_connect(client, userdata, flags, reason_code, properties):
+    logger.info("Connected with result code %s", reason_code)
+    client.subscribe("ping/command")
     if session_id:
         client.subscribe(f"pong/{session_id}/response")
 
-def on_pong_connect(client, userdata, flags, rc):
-    print(f"Pong connected with result code {rc}")
-    client.subscribe("ping/command")
-
-def on_ping_message(client, userdata, msg):
+def on_message(client, userdata, msg):
     try:
-        response = json.loads(msg.payload.decode())
-        response_queue.put(response)
-        print(f"Ping received: {response}")
+        # 解析器直接接受 bytes，省掉 decode
+        payload = fast_loads(msg.payload)
+        # 按主题前缀分发：响应归 ping 侧，命令归 pong 侧
+        if msg.topic.startswith("pong/"):
+            response_queue.append(payload)
+            # 懒格式化：级别被过滤时不做 dict→str 转换
+            logger.debug("Ping received: %s", payload)
+        else:
+            command_queue.put(payload)
+            logger.debug("Pong received: %s", payload)
     except Exception as e:
-        print(f"Ping error: {e}")
+        logger.error("Error processing message: %s", e)
 
-def on_pong_message(client, userdata, msg):
-    try:
-        command = json.loads(msg.payload.decode())
-        command_queue.put(command)
-        print(f"Pong received: {command}")
-    except Exception as e:
-        print(f"Pong error: {e}")
+# 连接后的 socket 调优：小控制消息禁用 Nagle，避免最多 40ms 的发送延迟
+def tune_socket(client):
+    sock = client.socket()
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if hasattr(socket, "TCP_QUICKACK"):  # 仅 Linux
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+    # 增大发送缓冲区，突发 publish 可以整批塞进内核
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+
+# 共享客户端：首次调用时建立连接，之后 Ping/Pong 两侧复用
+def ensure_client():
+    global mqtt_client
+    if mqtt_client is None:
+        # v2 回调 API：绕开 paho 对旧版回调签名的逐次适配层
+        mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        mqtt_client.on_connect = on_connect
+        mqtt_client.on_message = on_message
+        # 放宽在途/排队消息上限，让连续 publish 背靠背发送而不是被逐条限流
+        mqtt_client.max_inflight_messages_set(100)
+        mqtt_client.max_queued_messages_set(0)
+        mqtt_client.connect(MQTT_HOST, MQTT_PORT, 60)
+        tune_socket(mqtt_client)
+        mqtt_client.loop_start()
+    return mqtt_client
 
 # Ping 功能
 def initialize_ping():
-    global mqtt_ping_client, session_id
-    session_id = f"ping_{int(time.time())}"
-    mqtt_ping_client = mqtt.Client()
-    mqtt_ping_client.on_connect = on_ping_connect
-    mqtt_ping_client.on_message = on_ping_message
-    mqtt_ping_client.connect(MQTT_HOST, MQTT_PORT, 60)
-    mqtt_ping_client.loop_start()
+    global session_id
+    # 随机 ID：秒级时间戳在同一秒内重复初始化会撞出共享的响应主题
+    session_id = f"ping_{secrets.token_hex(4)}"
+    client = ensure_client()
+    client.subscribe(f"pong/{session_id}/response")
     return f"Ping initialized: {session_id}"
 
 def send_command(command_type, data=None):
-    if not mqtt_ping_client:
+    # 共享客户端也可能由 Pong 侧先启动，此时还没有 session_id，
+    # 仍然要求先初始化 Ping
+    if not mqtt_client or session_id is None:
         return "Please initialize ping first"
-    
+
     payload = {
         "type": command_type,
         "data": data or {},
         "session_id": session_id,
         "timestamp": time.time()
     }
-    mqtt_ping_client.publish("ping/command", json.dumps(payload))
+    # orjson.dumps 返回 bytes，paho 可以直接发送
+    mqtt_client.publish("ping/command", orjson.dumps(payload))
     return f"Sent {command_type}"
 
+# 固定形状的命令预编码成字节模板，publish 时只填变化的数字字段，
+# 跳过每次发送的完整 JSON 编码
+_RGB_TEMPLATE = (b'{"type":"RGB Command","data":{"r":%d,"g":%d,"b":%d},'
+                 b'"session_id":"%s","timestamp":%f}')
+_WEIGHT_TEMPLATE = (b'{"type":"Weight Data","data":{"set_rpm":%d,"request_weight":true},'
+                    b'"session_id":"%s","timestamp":%f}')
+
 def send_rgb(r, g, b):
-    if not mqtt_ping_client:
+    if not mqtt_client or session_id is None:
         return "Please initialize ping first"
-    
-    payload = {
+
+    now = time.time()
+    # 发送命令
+    mqtt_client.publish(
+        "ping/command",
+        _RGB_TEMPLATE % (int(r), int(g), int(b), session_id.encode(), now))
+    # 将命令放入命令队列供 pong 显示
+    command_queue.put({
         "type": "RGB Command",
         "data": {"r": r, "g": g, "b": b},
         "session_id": session_id,
-        "timestamp": time.time()
-    }
-    # 发送命令
-    mqtt_ping_client.publish("ping/command", json.dumps(payload))
-    # 将命令放入命令队列供 pong 显示
-    command_queue.put(payload)
+        "timestamp": now
+    })
     return f"Sent RGB Command: R={r}, G={g}, B={b}"
 
 def send_weight_request(rpm):
-    return send_command("Weight Data", {"set_rpm": rpm, "request_weight": True})
+    if not mqtt_client or session_id is None:
+        return "Please initialize ping first"
+    payload = _WEIGHT_TEMPLATE % (int(rpm), session_id.encode(), time.time())
+    mqtt_client.publish("ping/command", payload)
+    return "Sent Weight Data"
 
 # Pong 功能
 def initialize_pong():
-    global mqtt_pong_client
-    mqtt_pong_client = mqtt.Client()
-    mqtt_pong_client.on_connect = on_pong_connect
-    mqtt_pong_client.on_message = on_pong_message
-    mqtt_pong_client.connect(MQTT_HOST, MQTT_PORT, 60)
-    mqtt_pong_client.loop_start()
+    ensure_client()
     return "Pong started"
 
+# 常规命令一次取出全部三个字段（单次 C 层调用），缺字段才退回 .get；
+# 共享的空 dict 哨兵避免每条缺 data 的命令都新分配一个 {}
+_GET_FIELDS = operator.itemgetter("type", "data", "session_id")
+_EMPTY = {}
+
 def process_command(command):
-    global device_state
-    command_type = command.get("type")
-    data = command.get("data", {})
-    session_id = command.get("session_id")
-    
+    try:
+        command_type, data, session_id = _GET_FIELDS(command)
+    except KeyError:
+        command_type = command.get("type")
+        data = command.get("data", _EMPTY)
+        session_id = command.get("session_id")
+
     if command_type == "RGB Command":
-        # 更新设备状态
-        device_state = {
-            **device_state,
-            "rgb": {
-                "r": int(data.get("r", 0)),
-                "g": int(data.get("g", 0)),
-                "b": int(data.get("b", 0))
-            }
-        }
-        print(f"Processing RGB command: {data}")
+        # 原地更新设备状态，避免整份 state dict 的重建
+        rgb = device_state["rgb"]
+        rgb["r"] = int(data.get("r", 0))
+        rgb["g"] = int(data.get("g", 0))
+        rgb["b"] = int(data.get("b", 0))
+        logger.debug("Processing RGB command: %s", data)
         response_data = {
             "current_state": "applied",
             "power_consumption": random.uniform(0.1, 1.0),
@@ -140,78 +194,82 @@ def process_command(command):
     else:
         response_data = {"error": "Unknown command type"}
     
-    response = {
+    return {
         "type": command_type,
         "data": response_data,
         "timestamp": time.time(),
         "session_id": session_id
     }
-    
-    if mqtt_pong_client:
-        mqtt_pong_client.publish(f"pong/{session_id}/response", json.dumps(response))
-    return json.dumps(response, indent=2)
-
-def check_ping_responses():
-    """检查 ping 的响应队列"""
-    responses = []
-    while not response_queue.empty():
-        response = response_queue.get_nowait()
-        responses.append(json.dumps(response, indent=2))
-    return "\n".join(responses) if responses else "No new responses"
+
+def stream_ping_responses():
+    """通过单条长连接持续推送 ping 响应，取代每次点击一次 HTTP 往返的轮询"""
+    log = deque(maxlen=50)
+    while True:
+        # 逐条 popleft 排空：快照+clear 的组合不是原子的，两步之间
+        # 网络线程塞进来的消息会被 clear 悄悄丢掉
+        items = []
+        while response_queue:
+            items.append(response_queue.popleft())
+        for r in items:
+            log.append(orjson.dumps(r, option=orjson.OPT_INDENT_2).decode())
+        yield "\n".join(log) if log else "No responses yet"
+        time.sleep(0.1)
 
 def check_pong_commands():
-    """检查并处理命令队列"""
-    responses = []
-    while not command_queue.empty():
-        command = command_queue.get_nowait()
+    """检查并处理命令队列，按 session 聚合成单条批量响应"""
+    with command_queue.mutex:
+        commands = list(command_queue.queue)
+        command_queue.queue.clear()
+    if not commands:
+        return "No new commands"
+
+    # 同一 session 的响应合并成一条 {"batch": [...]} 消息，
+    # 每次排空只 publish 一次，而不是一条命令一次
+    batches = {}
+    for command in commands:
         response = process_command(command)
-        responses.append(response)
-    return "\n".join(responses) if responses else "No new commands"
+        batches.setdefault(response["session_id"], []).append(response)
+
+    display = []
+    for sid, batch in batches.items():
+        if mqtt_client:
+            mqtt_client.publish(f"pong/{sid}/response",
+                                orjson.dumps({"batch": batch}))
+        display.extend(
+            orjson.dumps(r, option=orjson.OPT_INDENT_2).decode() for r in batch)
+    return "\n".join(display)
 
 # 添加 stop_mqtt 函数
 def stop_mqtt():
-    global mqtt_ping_client, mqtt_pong_client
-    if mqtt_ping_client:
-        mqtt_ping_client.loop_stop()
-        mqtt_ping_client.disconnect()
-    if mqtt_pong_client:
-        mqtt_pong_client.loop_stop()
-        mqtt_pong_client.disconnect()
-    return "Both Ping and Pong clients stopped"
+    global mqtt_client
+    if mqtt_client:
+        mqtt_client.loop_stop()
+        mqtt_client.disconnect()
+        mqtt_client = None
+    return "Shared MQTT client stopped"
 
 # 添加实时更新函数
 def update_rgb_preview(r, g, b):
     """实时更新 RGB 预览值"""
-    global device_state
-    device_state = {
-        **device_state,
-        "rgb": {
-            "r": int(r),
-            "g": int(g),
-            "b": int(b)
-        }
-    }
-    return gr.update(value=device_state)
+    # 滑块拖动时每秒触发几十次，原地写字段即可，不要重建整个 dict
+    rgb = device_state["rgb"]
+    rgb["r"] = int(r)
+    rgb["g"] = int(g)
+    rgb["b"] = int(b)
+    # 只下发变化的子树，省掉整份 state 的重新序列化和传输
+    return gr.update(value={"rgb": rgb})
 
 # 添加 RPM 预览更新函数
 def update_rpm_preview(rpm):
     """实时更新 RPM 预览值"""
-    global device_state
-    device_state = {
-        **device_state,
-        "rpm": int(rpm)
-    }
-    return gr.update(value=device_state)
+    device_state["rpm"] = int(rpm)
+    return gr.update(value={"rpm": device_state["rpm"]})
 
 # 添加温度湿度预览更新函数
 def update_temperature_preview(temperature):
     """实时更新温度预览值"""
-    global device_state
-    device_state = {
-        **device_state,
-        "temperature": float(temperature)
-    }
-    return gr.update(value=device_state)
+    device_state["temperature"] = float(temperature)
+    return gr.update(value={"temperature": device_state["temperature"]})
 
 # Gradio 界面
 with gr.Blocks(title="MQTT Ping-Pong System", theme=gr.themes.Base(
@@ -339,8 +397,7 @@ with gr.Blocks(title="MQTT Ping-Pong System", theme=gr.themes.Base(
                         temp_status = gr.Textbox(label="Temperature Status", lines=2)
             
             with gr.Group():
-                gr.Markdown("**Step 4: Check Responses**")
-                check_ping_btn = gr.Button("Check Responses", variant="secondary", size="lg")
+                gr.Markdown("**Step 4: Responses (live)**")
                 ping_responses = gr.Textbox(
                     label="Response Log", 
                     lines=10, 
@@ -386,7 +443,7 @@ with gr.Blocks(title="MQTT Ping-Pong System", theme=gr.themes.Base(
     def refresh_all():
         """手动刷新所有状态"""
         commands = check_pong_commands()
-        print(f"Current device state: {device_state}")
+        logger.debug("Current device state: %s", device_state)
         
         # 返回三个更新：命令历史、设备状态和命令日志
         return [
@@ -408,9 +465,6 @@ with gr.Blocks(title="MQTT Ping-Pong System", theme=gr.themes.Base(
     ).then(
         check_pong_commands,  # 更新 pong 的命令显示
         outputs=[pong_commands]
-    ).then(
-        check_ping_responses,  # 更新 ping 的响应显示
-        outputs=[ping_responses]
     )
     send_weight_btn.click(
         send_weight_request,
@@ -421,29 +475,34 @@ with gr.Blocks(title="MQTT Ping-Pong System", theme=gr.themes.Base(
         outputs=[pong_commands, device_info, pong_commands]  # 添加 pong_commands 作为第三个输出
     )
     
-    check_ping_btn.click(
-        check_ping_responses,
-        outputs=ping_responses
-    )
     check_pong_btn.click(check_pong_commands, outputs=pong_commands)
+    # 页面加载后由生成器持续推送 ping 响应，不再需要手动刷新按钮
+    demo.load(stream_ping_responses, None, ping_responses)
     
-    # 修改手动刷新按钮的事件处理
+    # 手动刷新走 refresh_all：除了命令日志，也把完整 device_state
+    # 推回 device_info（预览更新只下发变化的子树，靠这里恢复全量视图）
     refresh_btn.click(
-        check_pong_commands,
-        outputs=[pong_commands],
+        refresh_all,
+        outputs=[pong_commands, device_info, pong_commands],
         show_progress=True
     )
 
     # 添加滑块值变化时的实时更新
-    r.change(update_rgb_preview, inputs=[r, g, b], outputs=device_info)
-    g.change(update_rgb_preview, inputs=[r, g, b], outputs=device_info)
-    b.change(update_rgb_preview, inputs=[r, g, b], outputs=device_info)
+    # trigger_mode="always_last" 把拖动过程中的几十个中间值合并成停下后的一次事件
+    r.change(update_rgb_preview, inputs=[r, g, b], outputs=device_info,
+             trigger_mode="always_last")
+    g.change(update_rgb_preview, inputs=[r, g, b], outputs=device_info,
+             trigger_mode="always_last")
+    b.change(update_rgb_preview, inputs=[r, g, b], outputs=device_info,
+             trigger_mode="always_last")
 
     # 添加 RPM 滑块的实时更新
-    rpm.change(update_rpm_preview, inputs=rpm, outputs=device_info)
+    rpm.change(update_rpm_preview, inputs=rpm, outputs=device_info,
+               trigger_mode="always_last")
 
     # 添加温度滑块的实时更新
-    temperature.change(update_temperature_preview, inputs=temperature, outputs=device_info)
+    temperature.change(update_temperature_preview, inputs=temperature,
+                       outputs=device_info, trigger_mode="always_last")
 
     # 添加温度命令发送处理
     send_temp_btn.click(
@@ -453,9 +512,6 @@ with gr.Blocks(title="MQTT Ping-Pong System", theme=gr.themes.Base(
     ).then(
         check_pong_commands,
         outputs=[pong_commands]
-    ).then(
-        check_ping_responses,
-        outputs=[ping_responses]
     )
 
     demo.load(lambda: None)  # 初始化
@@ -1,15 +1,60 @@
-import json
+try:
+    import orjson
+    _dumps = orjson.dumps
+except ImportError:
+    # 装不上 orjson 的老部署退回 stdlib 编码：复用单个紧凑分隔符的编码器，
+    # 省掉每次调用的 JSONEncoder 构建和键后的填充空格。
+    # 解码侧统一走 msgspec（见下方 _COMMAND_DECODER），不在此列
+    import json
+
+    _encode = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+
+    def _dumps(obj):
+        return _encode(obj).encode()
+
+import msgspec
 import gradio as gr
 import paho.mqtt.client as mqtt
+import os
+import socket
 import time
 import random
-from queue import Queue
+import logging
+from collections import deque
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+# 热路径逐条日志的总开关；打开时也只做懒格式化
+LOG_MESSAGES = False
 
 # 简单的全局配置和状态
 MQTT_HOST = "broker.hivemq.com"
 MQTT_PORT = 1883
-command_queue = Queue()
+# 模拟器响应是遥测性质，偶尔丢一条无所谓；QoS 0 免掉 PUBACK 往返，
+# 发布吞吐接近 QoS 1 的两倍
+PUBLISH_QOS = 0
+# 突发时 paho 默认的在途上限会卡住发布甚至丢消息；这里显式配置，
+# MAX_QUEUED = 0 表示出队无上限
+MAX_INFLIGHT = 1000
+MAX_QUEUED = 0
+# 已处理命令的展示历史，仅供 UI 显示（GIL 下 deque 的 append 线程安全）
+# 环形缓冲：超过 200 条自动丢最旧的，长会话内存严格有界
+command_history = deque(maxlen=200)
 mqtt_client = None
+# 固定 client_id + 持久会话：broker 端保留订阅，重连不用再付 SUB/SUBACK 往返。
+# 注意 broker.hivemq.com 是公共 broker，两个实例用同一 id 会互相踢下线，
+# 多实例时用 PONG_CLIENT_ID 环境变量区分
+MQTT_CLIENT_ID = os.environ.get("PONG_CLIENT_ID", "pong-simulator")
+
+# 命令的结构是固定的：msgspec 在 C 层直接解码进类型化 Struct，
+# 后续字段访问走属性槽，不再为每个字段做 dict 哈希查找
+class Command(msgspec.Struct):
+    type: str
+    data: dict = {}
+    session_id: str | None = None
+    timestamp: float = 0.0
+
+_COMMAND_DECODER = msgspec.json.Decoder(Command)
 
 # 模拟设备状态
 device_state = {
@@ -19,63 +64,104 @@ device_state = {
 }
 
 # 基础的 MQTT 回调函数
-def on_connect(client, userdata, flags, rc):
-    print(f"Connected with result code {rc}")
-    client.subscribe("ping/command")
+def on_connect(client, userdata, flags, reason_code, properties):
+    logger.info("Connected with result code %s", reason_code)
+    # broker 在 CONNACK 里告知是否还保有持久会话；会话丢失（过期或
+    # broker 重启）就重新订阅，否则跳过这次 SUB/SUBACK 往返
+    if not flags.session_present:
+        client.subscribe("ping/command", qos=0)
 
 def on_message(client, userdata, msg):
     try:
-        command = json.loads(msg.payload.decode())
-        command_queue.put(command)
-        print(f"Received command: {command}")
+        # 解码器直接接受 bytes，省掉整个 payload 的 decode 拷贝
+        command = _COMMAND_DECODER.decode(msg.payload)
+        if LOG_MESSAGES:
+            # 懒格式化：%s 参数只有真正输出时才做 dict→str 转换
+            logger.info("Received command: %s", command)
+        # 就地处理并回发：paho 网络线程里 publish 最便宜，免掉队列入出
+        # 和跨线程唤醒，往返延迟贴近 broker 的下限（经典 ping-pong 结构）
+        response = process_command(command)
+        payload = _dumps(response)
+        client.publish(topic_for(response["session_id"]), payload,
+                       qos=PUBLISH_QOS, retain=False)
+        # 历史仅供 UI 展示
+        command_history.append(payload.decode())
     except Exception as e:
-        print(f"Error processing message: {e}")
+        logger.error("Error processing message: %s", e)
+
+# 各命令类型的处理函数
+def process_rgb_command(data):
+    device_state["rgb"] = data
+    return {
+        "current_state": "applied",
+        "power_consumption": random.uniform(0.1, 1.0),
+        "applied_values": device_state["rgb"]
+    }
+
+def process_temperature_reading(data):
+    device_state["temperature"] += random.uniform(-0.5, 0.5)
+    return {
+        "current_temperature": device_state["temperature"],
+        "humidity": random.uniform(40, 60),
+        "pressure": random.uniform(980, 1020)
+    }
 
-# 处理接收到的命令
+def process_weight_data(data):
+    if "set_rpm" in data:
+        device_state["rpm"] = data["set_rpm"]
+    return {
+        "calibrated_weight": random.uniform(95, 105),
+        "current_rpm": device_state["rpm"],
+        "stability": random.uniform(0.98, 1.02)
+    }
+
+# session_id 会重复出现，缓存响应主题字符串省掉逐条消息的 f-string 格式化
+@lru_cache(maxsize=4096)
+def topic_for(session_id):
+    return f"pong/{session_id}/response"
+
+# 命令类型 → 处理函数：一次哈希查找取代逐个字符串比较
+HANDLERS = {
+    "RGB Command": process_rgb_command,
+    "Temperature Reading": process_temperature_reading,
+    "Weight Data": process_weight_data,
+}
+
+# 处理接收到的命令（Command Struct，字段直接按属性访问）
 def process_command(command):
-    command_type = command.get("type")
-    data = command.get("data", {})
-    session_id = command.get("session_id")
-    
-    if command_type == "RGB Command":
-        device_state["rgb"] = data
-        response_data = {
-            "current_state": "applied",
-            "power_consumption": random.uniform(0.1, 1.0),
-            "applied_values": device_state["rgb"]
-        }
-    elif command_type == "Temperature Reading":
-        device_state["temperature"] += random.uniform(-0.5, 0.5)
-        response_data = {
-            "current_temperature": device_state["temperature"],
-            "humidity": random.uniform(40, 60),
-            "pressure": random.uniform(980, 1020)
-        }
-    elif command_type == "Weight Data":
-        if "set_rpm" in data:
-            device_state["rpm"] = data["set_rpm"]
-        response_data = {
-            "calibrated_weight": random.uniform(95, 105),
-            "current_rpm": device_state["rpm"],
-            "stability": random.uniform(0.98, 1.02)
-        }
-    else:
-        response_data = {"error": "Unknown command type"}
-    
+    handler = HANDLERS.get(command.type)
+    response_data = handler(command.data) if handler else {"error": "Unknown command type"}
+
     return {
-        "type": command_type,
+        "type": command.type,
         "data": response_data,
         "timestamp": time.time(),
-        "session_id": session_id
+        "session_id": command.session_id
     }
 
 # MQTT 客户端控制
 def start_mqtt():
     global mqtt_client
-    mqtt_client = mqtt.Client()
+    # 已连接则复用同一个客户端，重复点击不再重新握手、泄漏旧的网络线程
+    if mqtt_client is not None and mqtt_client.is_connected():
+        return "MQTT client already running"
+    # v2 回调 API：绕开 paho 对旧版回调签名的逐次适配层
+    mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2,
+                              client_id=MQTT_CLIENT_ID, clean_session=False)
     mqtt_client.on_connect = on_connect
     mqtt_client.on_message = on_message
+    # 放宽在途/排队消息上限，突发批量 publish 不被逐条限流
+    mqtt_client.max_inflight_messages_set(MAX_INFLIGHT)
+    mqtt_client.max_queued_messages_set(MAX_QUEUED)
+    # 断线重连用温和的指数退避，避免 broker 抖动时的重连风暴
+    mqtt_client.reconnect_delay_set(min_delay=1, max_delay=16)
     mqtt_client.connect(MQTT_HOST, MQTT_PORT, 60)
+    # 小响应消息禁用 Nagle，成批发送时合并进尽量少的 TCP 段；
+    # 加大内核收发缓冲区，让整批消息一次写进去
+    sock = mqtt_client.socket()
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
     mqtt_client.loop_start()
     return "MQTT client started"
 
@@ -85,20 +171,14 @@ def stop_mqtt():
         mqtt_client.disconnect()
     return "MQTT client stopped"
 
-# 检查和处理命令
+# UI 刷新只读展示历史，不再承担命令处理
 def check_commands():
     if not mqtt_client:
         return "MQTT client not started"
-    
-    responses = []
-    while not command_queue.empty():
-        command = command_queue.get_nowait()
-        response = process_command(command)
-        mqtt_client.publish(f"pong/{response['session_id']}/response", 
-                          json.dumps(response))
-        responses.append(json.dumps(response, indent=2))
-    
-    return "\n".join(responses) if responses else "No new commands"
+    if not command_history:
+        return "No new commands"
+    # 只渲染最近 20 条，文本框的重绘开销与历史长度脱钩
+    return "\n".join(list(command_history)[-20:])
 
 # Gradio 界面
 with gr.Blocks(title="MQTT Pong", theme=gr.themes.Soft(